@@ -5,11 +5,16 @@ import logging
 import typing as t
 import time
 from .connection import *
-from .util import chunked
+from .connection import _s, _frame_chat, _I16
+from .util import chunked, _encode_cached, zlib
 from .typing import *
 from .__version__ import __version__
 
-from gzip import decompress
+
+# whole-packet formats for the fixed-size hot paths
+_CHANGE_BLOCK = _s("B3HBB")
+_PACKET_HDR = _s("2B")
+_HELLO = _s("2B64s64sB")
 
 
 class ServerConnectionHandler(ServerSession, BaseConnection):
@@ -23,32 +28,32 @@ class ServerConnectionHandler(ServerSession, BaseConnection):
         self.holding = 0
         self._receiving_level = False
         self._level_buffer = None
+        self._level_decompressor = None
         self._last_location = None
         self._last_held = None
-        self._partial_message = b''
+        self._partial_message = bytearray()
 
     # ServerConnection implementation
 
     def hello(self, username, password):
-        self.write_byte(OPCODE_HELLO)
-        self.write_byte(7)  # version
-        self.write_string(username)
-        self.write_string(password)
-        self.write_byte(66)
+        encoding = self._text_encoding
+        self._out += _HELLO.pack(OPCODE_HELLO, 7, _encode_cached(username, encoding),
+                                 _encode_cached(password, encoding), 66)
+        self._flush()
 
     def change_held(self, block):
-        if HeldBlock in self.extensions:
+        if self._has_held_block:
             self.change_location(*self._last_location, block)
         self.holding = block
 
     def change_location(self, x, y, z, yaw, pitch, holding=0):
-        self.write_byte(OPCODE_ABSOLUTE_LOCATION)
-        self.write_byte(holding)
+        self._out += _PACKET_HDR.pack(OPCODE_ABSOLUTE_LOCATION, holding)
         self.write_location(x, y, z, yaw, pitch)
+        self._flush()
         self._last_location = x, y, z, yaw, pitch
 
     def set_block(self, x, y, z, block):
-        placed = not not block
+        placed = bool(block)
         self.holding = block
         self.change_block(x, y, z, placed, block)
 
@@ -60,18 +65,12 @@ class ServerConnectionHandler(ServerSession, BaseConnection):
         self.change_block(x, y, z, False, holding)
 
     def change_block(self, x, y, z, placed: bool, holding: int):
-        self.write_byte(OPCODE_CHANGE_BLOCK)
-        self.write_position(x, y, z)
-        self.write_byte(placed)
-        self.write_byte(holding)
+        self._out += _CHANGE_BLOCK.pack(OPCODE_CHANGE_BLOCK, x, y, z, placed, holding)
+        self._flush()
 
     def submit_message(self, message: str):
-        partial = 0
-        for chunk in chunked(message, 64):
-            self.write_byte(OPCODE_MESSAGE)
-            self.write_byte(partial)
-            self.write_string(chunk)
-            partial = 1
+        self._out += _frame_chat(message, self._text_encoding, continuation=True)
+        self._flush()
 
     # Disconnection
 
@@ -105,9 +104,8 @@ class ServerConnectionHandler(ServerSession, BaseConnection):
 
     async def _handle_move_entity(self):
         entity_number = await self.read_byte()
-        location = await self.read_position()
-        yaw, pitch = await self.read_struct("2B")
-        self.handler.move_entity(entity_number, *location, yaw, pitch)
+        location = await self.read_location()
+        self.handler.move_entity(entity_number, *location)
 
     async def _handle_relative_location(self):
         number = await self.read_byte()
@@ -131,21 +129,28 @@ class ServerConnectionHandler(ServerSession, BaseConnection):
     async def _handle_level_start(self):
         self._receiving_level = True
         self._level_buffer = bytearray()
+        self._level_decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
 
     async def _handle_level_chunk(self):
-        size = await self.read_short()
-        chunk, = await self.read_struct("1024s")
-        complete = await self.read_byte()
+        # size (short) + chunk (1024s) + percent complete (byte) in one read;
+        # slicing a memoryview appends straight into the buffer with no
+        # intermediate bytes object per chunk.
+        raw = await self._rx(1027)
         if self._receiving_level:
-            self._level_buffer += chunk[:size]
+            size = _I16.unpack_from(raw)[0]
+            # decompress incrementally so the compressed stream is never
+            # held in memory and the final gzip pass is spread over chunks
+            self._level_buffer += self._level_decompressor.decompress(memoryview(raw)[2:2 + size])
 
     async def _handle_level_end(self):
         x, y, z = await self.read_struct("3H")
         if self._receiving_level:
-            buff = decompress(self._level_buffer)
-            self.handler.send_level(x, y, z, buff[4:])
+            self._level_buffer += self._level_decompressor.flush()
+            # the first 4 bytes are the volume prefix, not block data
+            self.handler.send_level(x, y, z, bytes(memoryview(self._level_buffer)[4:]))
             self._receiving_level = False
             self._level_buffer = None
+            self._level_decompressor = None
 
     async def _handle_hello(self):
         version = await self.read_byte()
@@ -182,6 +187,18 @@ class ServerConnectionHandler(ServerSession, BaseConnection):
     def received_extensions(self):
         super().received_extensions()
         self.write_extensions()
+        self._specialize_handlers()
+
+    def _specialize_handlers(self):
+        """Swap in handlers fused to one read for the negotiated formats."""
+        packet = _s("B" + self._location_struct.format[1:])
+        read = self._rx
+
+        async def handle_move_entity():
+            data = packet.unpack(await read(packet.size))
+            self.handler.move_entity(*data)
+
+        self._handlers[OPCODE_ABSOLUTE_LOCATION] = handle_move_entity
 
     async def _handle_heartbeat(self):
         self.last_heartbeat = time.time()
@@ -219,5 +236,6 @@ class ServerConnectionHandler(ServerSession, BaseConnection):
 
 
 async def _connect(handler_factory, host, port=25565, handler_class=ServerConnectionHandler, **kwargs):
+    kwargs.setdefault("limit", STREAM_BUFFER_LIMIT)
     reader, writer = await asyncio.open_connection(host, port, **kwargs)
     return handler_class(reader, writer, handler_factory)
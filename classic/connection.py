@@ -5,9 +5,9 @@ import asyncio
 import logging
 import typing as t
 from struct import Struct
-from functools import partialmethod
+from functools import lru_cache, partialmethod
 from asyncio import StreamReader, StreamWriter
-from .util import decode_classic_string, encode_classic_string
+from .util import chunked, decode_classic_string, encode_classic_string, _encode_cached
 from .__version__ import __version__
 
 
@@ -26,96 +26,185 @@ TextColors = Extension("TextColors")
 BlockPermissions = Extension("BlockPermissions")
 PlayerClick = Extension("PlayerClick")
 
+# each known extension gets a bit, so hot paths can test membership with a
+# single integer AND on extensions_mask instead of a set lookup
+_EXT_BITS = {extension: 1 << bit for bit, extension in enumerate((
+    ExtPlayerList2, EntityPositions, HeldBlock, FullCP437, MessageTypes,
+    LongerMessages, TextColors, BlockPermissions, PlayerClick))}
+
+_B_PLAYER_LIST = _EXT_BITS[ExtPlayerList2]
+_B_ENTITY_POSITIONS = _EXT_BITS[EntityPositions]
+_B_HELD_BLOCK = _EXT_BITS[HeldBlock]
+_B_FULL_CP437 = _EXT_BITS[FullCP437]
+_B_MESSAGE_TYPES = _EXT_BITS[MessageTypes]
+_B_TEXT_COLORS = _EXT_BITS[TextColors]
+_B_BLOCK_PERMISSIONS = _EXT_BITS[BlockPermissions]
+
 
 NO_VENDOR = "(no vendor)"
 UNKNOWN_VENDOR = "(unknown)"
 PARSER_DEBUG = True
 
+# Stream buffer size for connections; large enough to hold a full burst of
+# level chunks so bulk traffic is delivered in few, big reads.
+STREAM_BUFFER_LIMIT = 2 ** 16
+
+
+_STRUCT_CACHE: t.Dict[str, Struct] = {}
+
+
+def _s(fmt: str) -> Struct:
+    """Return a cached network-order Struct for the given format."""
+    struct = _STRUCT_CACHE.get(fmt)
+    if struct is None:
+        struct = _STRUCT_CACHE[fmt] = Struct("!" + fmt)
+    return struct
+
+
+_U8 = _s("B")
+_I16 = _s("h")
+_U32 = _s("I")
+
+
+@lru_cache(maxsize=256)
+def _frame_chat(message: str, encoding: str, continuation: bool = False) -> bytes:
+    """Render a chat message into framed MESSAGE packets. Cached because a
+    broadcast emits the identical bytes to every client."""
+    hdr = _s("2B")
+    out = bytearray()
+    flag = 0
+    for chunk in chunked(message, 64):
+        out += hdr.pack(OPCODE_MESSAGE, flag)
+        out += _encode_cached(chunk, encoding)
+        if continuation:
+            flag = 1
+    return bytes(out)
+
 
 _PacketHandler = t.Callable[['BaseConnection'], t.Awaitable]
 
 
 class BaseConnection:
+    _handlers_tbl: t.List[_PacketHandler]
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._handlers_tbl = cls.handlers()
+        cls._supported_extensions = tuple(cls.supported_extensions())
+        cls._ext_packet = cls._build_ext_packet()
+
     def __init__(self, reader: StreamReader, writer: StreamWriter, handler_factory):
         self.reader = reader
         self.writer = writer
+        # bound once; every stream read/write below goes through these
+        self._rx = reader.readexactly
+        self._tx = writer.write
+        self._drain = writer.drain
 
         self.handler_factory = handler_factory
         self.handler = None
         self.logger = logging.getLogger(self.__class__.__name__)
 
-        self._handlers: t.List[_PacketHandler] = self.handlers()
-        self.supported_extensions: t.Tuple[Extension] = tuple(self.supported_extensions())
+        # bind the class-level handler table once, so dispatch is a plain
+        # index into already-bound methods; a list so negotiation can swap
+        # in handlers specialized for the agreed extension set
+        self._handlers = [h.__get__(self) for h in self._handlers_tbl]
+        self.supported_extensions: t.Tuple[Extension] = self._supported_extensions
 
         self.alive = True
         self.vendor = NO_VENDOR
         self.extensions: t.Set[Extension] = set()
+        self.extensions_mask: int = 0
+        # frozen per-extension flags; a plain attribute load beats even the
+        # mask AND in the per-entity and per-packet paths below
+        self._has_player_list = False
+        self._has_held_block = False
+        self._has_message_types = False
+        self._has_text_colors = False
+        self._has_block_permissions = False
 
         self.current_opcode = None
         self.last_opcode = None
 
         self._text_encoding = "ascii"
-        self._location_struct = "3h2B"
+        self._location_struct = _s("3h2B")
         self._ext_left = 0
+        self._out = bytearray()
+        # servers broadcasting at a fixed tick rate can set this False and
+        # call flush() once per tick to coalesce every packet of the tick
+        # into a single transport write
+        self.autoflush = True
+
+    def flush(self) -> None:
+        """Send the accumulated packet bytes to the transport in one write."""
+        if self._out:
+            # hand the transport the buffer itself and start a fresh one;
+            # nothing touches the old buffer again, so the bytes() copy
+            # the transport would otherwise force on us goes away
+            buf = self._out
+            self._out = bytearray()
+            self._tx(buf)
+
+    def _flush(self) -> None:
+        """Autoflush hook run at the end of every packet method."""
+        if self.autoflush:
+            self.flush()
 
     async def read_struct(self, fmt) -> tuple:
         """Read the given struct format from the stream."""
-        _struct = Struct("!" + fmt)
-        data = await self.reader.readexactly(_struct.size)
+        _struct = _s(fmt)
+        data = await self._rx(_struct.size)
         return _struct.unpack(data)
 
     def write_struct(self, fmt, *args) -> None:
         """Write the given struct format to the stream."""
-        _struct = Struct("!" + fmt)
-        buff = _struct.pack(*args)
-        self.writer.write(buff)
+        self._out += _s(fmt).pack(*args)
 
     async def read_byte(self) -> int:
         """Read an unsigned 8-bit integer."""
-        data = await self.reader.readexactly(1)
-        return int.from_bytes(data, 'big')
+        data = await self._rx(1)
+        return data[0]
 
     def write_byte(self, x: int) -> None:
         """Write an unsigned 8-bit integer."""
-        buff = int.to_bytes(x, 1, 'big')
-        self.writer.write(buff)
+        self._out += _U8.pack(x)
 
     async def read_short(self) -> int:
         """Read a signed 16-bit integer."""
-        data = await self.reader.readexactly(2)
-        return int.from_bytes(data, 'big', signed=True)
+        data = await self._rx(2)
+        return _I16.unpack(data)[0]
 
     def write_short(self, x: int) -> None:
         """Write a signed 16-bit integer."""
-        buff = x.to_bytes(2, 'big', signed=True)
-        self.writer.write(buff)
+        self._out += _I16.pack(x)
 
     async def read_int(self) -> int:
         """Read an unsigned 32-bit integer."""
-        data = await self.reader.readexactly(4)
-        return int.from_bytes(data, 'big')
+        data = await self._rx(4)
+        return _U32.unpack(data)[0]
 
     def write_int(self, x: int) -> None:
         """Write an unsigned 32-bit integer."""
-        buff = x.to_bytes(4, 'big')
-        self.writer.write(buff)
+        self._out += _U32.pack(x)
 
     async def read_string(self) -> str:
         """Read a space-padding string."""
-        data = await self.reader.readexactly(64)
+        data = await self._rx(64)
         return decode_classic_string(data, self._text_encoding)
 
     def write_string(self, x: str) -> None:
         """Write a space-padded string."""
-        self.writer.write(encode_classic_string(x, self._text_encoding))
+        self._out += _encode_cached(x, self._text_encoding)
 
     async def read_location(self):
         """Read a fractional-space location (32 units/block, yaw/pitch)"""
-        return await self.read_struct(self._location_struct)
+        _struct = self._location_struct
+        data = await self._rx(_struct.size)
+        return _struct.unpack(data)
 
     def write_location(self, x, y, z, yaw, pitch):
         """Write a fractional-space location (32 units/block, yaw/pitch)"""
-        self.write_struct(self._location_struct, x, y, z, yaw, pitch)
+        self._out += self._location_struct.pack(x, y, z, yaw, pitch)
 
     async def read_position(self):
         """Read a block-space position (1 unit/block)"""
@@ -125,28 +214,47 @@ class BaseConnection:
         """Write a block-space position (1 unit/block)"""
         self.write_struct("3H", x, y, z)
 
+    @classmethod
+    def _build_ext_packet(cls) -> bytes:
+        """Build the ExtInfo/ExtEntry handshake; identical for every
+        instance of a class, so it is computed once at class creation."""
+        out = bytearray()
+        out += _U8.pack(OPCODE_EXT_INFO)
+        out += _encode_cached(cls.__name__ + "/" + __version__, "ascii")
+        out += _I16.pack(len(cls._supported_extensions))
+        for extension in cls._supported_extensions:
+            out += _U8.pack(OPCODE_EXT_ENTRY)
+            out += _encode_cached(extension.name, "ascii")
+            out += _U32.pack(extension.version)
+        return bytes(out)
+
     def write_extensions(self):
         """Write all members of supported_extensions to the string."""
-        self.write_byte(OPCODE_EXT_INFO)
-        self.write_string(self.agent)
-        self.write_short(len(self.supported_extensions))
-        for extension in self.supported_extensions:
-            self.write_byte(OPCODE_EXT_ENTRY)
-            self.write_string(extension.name)
-            self.write_int(extension.version)
+        self._out += self._ext_packet
+        self._flush()
 
     def received_extensions(self):
         """Handle receipt of all extensions from the remote peer."""
-        if EntityPositions in self.extensions:
-            self._location_struct = "3i2B"
-        if FullCP437 in self.extensions:
+        mask = self.extensions_mask
+        if mask & _B_ENTITY_POSITIONS:
+            self._location_struct = _s("3i2B")
+        if mask & _B_FULL_CP437:
             self._text_encoding = "cp437"
+        self._has_player_list = bool(mask & _B_PLAYER_LIST)
+        self._has_held_block = bool(mask & _B_HELD_BLOCK)
+        self._has_message_types = bool(mask & _B_MESSAGE_TYPES)
+        self._has_text_colors = bool(mask & _B_TEXT_COLORS)
+        self._has_block_permissions = bool(mask & _B_BLOCK_PERMISSIONS)
 
     def close(self):
         self.alive = False
 
     async def handle_unknown(self):
-        self.close()
+        size = OPCODE_SIZES[self.current_opcode]
+        if size < 0:
+            self.close()
+        elif size:
+            await self._rx(size)
 
     async def handle_ext_info(self):
         self.vendor = await self.read_string()
@@ -159,6 +267,7 @@ class BaseConnection:
             self.close()
         ext = Extension(ext_name, version)
         self.extensions.add(ext)
+        self.extensions_mask |= _EXT_BITS.get(ext, 0)
         self._ext_left -= 1
         if not self._ext_left:
             self.received_extensions()
@@ -166,14 +275,15 @@ class BaseConnection:
     async def handle_next(self):
         opcode = await self.read_byte()
         self.current_opcode = opcode
-        await self._handlers[opcode](self)
+        await self._handlers[opcode]()
         self.current_opcode = None
         self.last_opcode = opcode
 
     async def handle_forever(self):
+        handle_next = self.handle_next
         try:
             while self.alive:
-                await self.handle_next()
+                await handle_next()
         except (ConnectionResetError, EOFError):
             self.close()
 
@@ -228,3 +338,39 @@ OPCODE_ADD_ENTITY_EXT = 0x21
 OPCODE_SET_TEXT_COLOR = 0x27
 OPCODE_SET_BLOCK_PERMISSION = 0x1C
 OPCODE_CLICK = 0x22
+
+
+# Payload size (after the opcode byte) for every fixed-size packet, so
+# handle_unknown can skip packets it has no handler for instead of dropping
+# the connection. -1 closes; location-bearing packets stay at -1 because
+# their size depends on the negotiated extensions.
+OPCODE_SIZES = [-1] * 256
+OPCODE_SIZES[OPCODE_HELLO] = 130
+OPCODE_SIZES[OPCODE_HEARTBEAT] = 0
+OPCODE_SIZES[OPCODE_START_LEVEL] = 0
+OPCODE_SIZES[OPCODE_LEVEL_CHUNK] = 1027
+OPCODE_SIZES[OPCODE_FINISH_LEVEL] = 6
+OPCODE_SIZES[OPCODE_CHANGE_BLOCK] = 8
+OPCODE_SIZES[OPCODE_SET_BLOCK] = 7
+OPCODE_SIZES[OPCODE_REMOVE_ENTITY] = 1
+OPCODE_SIZES[OPCODE_RELATIVE_LOCATION] = 6
+OPCODE_SIZES[OPCODE_RELATIVE_POSITION] = 4
+OPCODE_SIZES[OPCODE_RELATIVE_ORIENTATION] = 3
+OPCODE_SIZES[OPCODE_MESSAGE] = 65
+OPCODE_SIZES[OPCODE_DISCONNECT] = 64
+OPCODE_SIZES[OPCODE_ADMIN_STATUS] = 1
+OPCODE_SIZES[OPCODE_EXT_INFO] = 66
+OPCODE_SIZES[OPCODE_EXT_ENTRY] = 68
+OPCODE_SIZES[OPCODE_HOLD_THIS] = 2
+OPCODE_SIZES[OPCODE_ADD_PLAYER] = 195
+OPCODE_SIZES[OPCODE_REMOVE_PLAYER] = 2
+OPCODE_SIZES[OPCODE_SET_TEXT_COLOR] = 5
+OPCODE_SIZES[OPCODE_SET_BLOCK_PERMISSION] = 3
+OPCODE_SIZES[OPCODE_CLICK] = 14
+
+
+# __init_subclass__ covers subclasses; the base tables need the opcode
+# constants above, so they are built here
+BaseConnection._handlers_tbl = BaseConnection.handlers()
+BaseConnection._supported_extensions = tuple(BaseConnection.supported_extensions())
+BaseConnection._ext_packet = BaseConnection._build_ext_packet()
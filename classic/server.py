@@ -2,23 +2,29 @@
 Classic server for Python
 """
 import logging
+import socket
 from .typing import *
 from .connection import *
-from .util import chunked, decode_classic_string, encode_classic_string
-from functools import wraps
-from gzip import compress
+from .connection import _s, _frame_chat, _U8, _U32
+from .util import chunked, decode_classic_string, encode_classic_string, _encode_cached, zlib
 
 
 logger = logging.getLogger(__name__)
 
 
-def if_alive(func):
-    @wraps(func)
-    def check_alive(*args, **kwargs):
-        instance = args[0]
-        if instance.alive:
-            func(*args, **kwargs)
-    return check_alive
+# whole-packet formats for the fixed-size hot paths
+_PACKET_HDR = _s("2B")
+_LEVEL_CHUNK_HDR = _s("Bh")
+_FINISH_LEVEL = _s("B3H")
+_SET_BLOCK = _s("B3HB")
+_HOLD_THIS = _s("3B")
+_REMOVE_PLAYER = _s("Bh")
+_BLOCK_PERMISSION = _s("4B")
+_ADD_ENTITY_HDR = _s("2B64s")
+_ADD_ENTITY_EXT_HDR = _s("2B64s64s")
+_ADD_PLAYER = _s("Bh64s64s64sB")
+_WORLD_INFO = _s("2B64s64sB")
+_KICK = _s("B64s")
 
 
 class ClientConnectionHandler(ClientSession, BaseConnection):
@@ -30,7 +36,7 @@ class ClientConnectionHandler(ClientSession, BaseConnection):
         self.token = None
         self._last_location = None
         self._last_held = None
-        self._partial_message = b''
+        self._partial_message = bytearray()
 
     def __str__(self):
         name = self.username
@@ -41,121 +47,155 @@ class ClientConnectionHandler(ClientSession, BaseConnection):
 
     # ClientConnection implementation
 
-    @if_alive
     def add_entity(self, entity_number: int, name: str, x: int, y: int, z: int,
                    yaw: int, pitch: int, skin=None):
-        support_plr_list = ExtPlayerList2 in self.extensions
-        opcode = OPCODE_ADD_ENTITY_EXT if support_plr_list else OPCODE_ADD_ENTITY
-        self.write_byte(opcode)
-        self.write_byte(entity_number)
-        self.write_string(name)
-        if support_plr_list:
-            self.write_string(skin or name)
+        if not self.alive:
+            return
+        encoding = self._text_encoding
+        if self._has_player_list:
+            self._out += _ADD_ENTITY_EXT_HDR.pack(
+                OPCODE_ADD_ENTITY_EXT, entity_number,
+                _encode_cached(name, encoding), _encode_cached(skin or name, encoding))
+        else:
+            self._out += _ADD_ENTITY_HDR.pack(
+                OPCODE_ADD_ENTITY, entity_number, _encode_cached(name, encoding))
         self.write_location(x, y, z, yaw, pitch)
+        self._flush()
 
-    @if_alive
     def move_entity(self, entity_number: int, x, y, z, yaw, pitch):
-        self.write_byte(OPCODE_ABSOLUTE_LOCATION)
-        self.write_byte(entity_number)
+        if not self.alive:
+            return
+        self._out += _PACKET_HDR.pack(OPCODE_ABSOLUTE_LOCATION, entity_number)
         self.write_location(x, y, z, yaw, pitch)
+        self._flush()
 
-    @if_alive
     def remove_entity(self, entity_number: int):
-        self.write_byte(OPCODE_REMOVE_ENTITY)
-        self.write_byte(entity_number)
+        if not self.alive:
+            return
+        self._out += _PACKET_HDR.pack(OPCODE_REMOVE_ENTITY, entity_number)
+        self._flush()
 
-    @if_alive
     def world_info(self, name, message, is_operator=False):
-        self.write_byte(OPCODE_HELLO)
-        self.write_string(name)
-        self.write_string(message)
-        self.write_byte(is_operator)
+        if not self.alive:
+            return
+        encoding = self._text_encoding
+        self._out += _WORLD_INFO.pack(OPCODE_HELLO, 7, _encode_cached(name, encoding),
+                                      _encode_cached(message, encoding), is_operator)
+        self._flush()
 
-    @if_alive
     def send_level(self, x: int, y: int, z: int, data: bytes, **kwargs):
-        self.write_byte(OPCODE_START_LEVEL)
+        if not self.alive:
+            return
+        self.flush()  # keep packet order even when autoflush is off
         volume: int = len(data)
-        data = compress(volume.to_bytes(4, 'big') + data, 1)
-        for chunk in chunked(data, 1024):
-            self.write_byte(OPCODE_LEVEL_CHUNK)
-            self.write_short(len(chunk))
-            self.write_struct("1024s", chunk)
-            self.write_byte(0)
-        self.write_byte(OPCODE_FINISH_LEVEL)
-        self.write_position(x, y, z)
-
-    @if_alive
+        # feed the volume prefix and the level through one streaming
+        # compressor instead of concatenating them into a full copy first;
+        # memLevel=9 buys bigger hash tables, and 64 KiB slices keep each
+        # compress() call long enough to amortize its setup
+        compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS, 9)
+        frames = [_U8.pack(OPCODE_START_LEVEL)]
+        pending = bytearray(compressor.compress(_U32.pack(volume)))
+
+        def drain():
+            # peel full frames off the front of the compressor output;
+            # the short remainder carries over into the next compress()
+            pos = 0
+            while len(pending) - pos >= 1024:
+                frames.append(_LEVEL_CHUNK_HDR.pack(OPCODE_LEVEL_CHUNK, 1024))
+                frames.append(pending[pos:pos + 1024])
+                frames.append(b'\x00')  # percent complete; not tracked
+                pos += 1024
+            del pending[:pos]
+
+        for pos in range(0, volume, 65536):
+            pending += compressor.compress(data[pos:pos + 65536])
+            drain()
+        pending += compressor.flush()
+        drain()
+        if pending:
+            frames.append(_LEVEL_CHUNK_HDR.pack(OPCODE_LEVEL_CHUNK, len(pending)))
+            frames.append(pending.ljust(1024, b'\x00'))
+            frames.append(b'\x00')
+        frames.append(_FINISH_LEVEL.pack(OPCODE_FINISH_LEVEL, x, y, z))
+        # writelines scatter-gathers the frame list without copying it
+        # through the packet buffer
+        self.writer.writelines(frames)
+
     def set_block(self, x, y, z, block):
-        self.write_byte(OPCODE_SET_BLOCK)
-        self.write_position(x, y, z)
-        self.write_byte(block)
+        if not self.alive:
+            return
+        self._out += _SET_BLOCK.pack(OPCODE_SET_BLOCK, x, y, z, block)
+        self._flush()
 
-    @if_alive
     def send_message(self, message, message_type=None):
+        if not self.alive:
+            return
         if message_type:
-            self.write_byte(OPCODE_MESSAGE)
-            self.write_byte(message_type)
+            self._out += _PACKET_HDR.pack(OPCODE_MESSAGE, message_type)
             self.write_string(message)
         else:
-            for chunk in chunked(message, 64):
-                self.write_byte(OPCODE_MESSAGE)
-                self.write_byte(0)
-                self.write_string(chunk)
+            self._out += _frame_chat(message, self._text_encoding)
+        self._flush()
 
     def set_message(self, message_type: int, message: str):
-        if MessageTypes in self.extensions:
+        if self._has_message_types:
             self.send_message(message, message_type)
 
-    @if_alive
     def set_location(self, entity_number, *loc):
-        self.write_byte(OPCODE_ABSOLUTE_LOCATION)
-        self.write_byte(entity_number)
+        if not self.alive:
+            return
+        self._out += _PACKET_HDR.pack(OPCODE_ABSOLUTE_LOCATION, entity_number)
         self.write_location(*loc)
+        self._flush()
         if entity_number == 255:
             self._last_location = loc
 
-    @if_alive
     def kick(self, message="No reason given."):
-        self.write_byte(OPCODE_DISCONNECT)
-        self.write_string(message)
+        if not self.alive:
+            return
+        self._out += _KICK.pack(OPCODE_DISCONNECT, _encode_cached(message, self._text_encoding))
+        self._flush()
         self.close()
 
-    @if_alive
     def set_color_code(self, number, r, g, b, a=255):
-        if TextColors in self.extensions:
-            self.write_struct("4Bc", r, g, b, a, number)
+        if not self.alive:
+            return
+        if self._has_text_colors:
+            self.write_struct("6B", OPCODE_SET_TEXT_COLOR, r, g, b, a, number)
+            self._flush()
 
-    @if_alive
     def set_block_permission(self, block, create: bool, destroy: bool):
-        if BlockPermissions in self.extensions:
-            self.write_byte(OPCODE_SET_BLOCK_PERMISSION)
-            self.write_byte(block)
-            self.write_byte(create)
-            self.write_byte(destroy)
+        if not self.alive:
+            return
+        if self._has_block_permissions:
+            self._out += _BLOCK_PERMISSION.pack(OPCODE_SET_BLOCK_PERMISSION, block, create, destroy)
+            self._flush()
 
-    @if_alive
     def add_player(self, player_id: int, name: str, display_name=None, order=None, group=""):
-        if ExtPlayerList2 not in self.extensions:
+        if not self.alive:
+            return
+        if not self._has_player_list:
             return
-        self.write_byte(OPCODE_ADD_PLAYER)
-        self.write_short(player_id)
-        self.write_string(name)
-        self.write_string(display_name or name)
-        self.write_string(group)
-        self.write_byte(order or player_id)
-
-    @if_alive
+        encoding = self._text_encoding
+        self._out += _ADD_PLAYER.pack(
+            OPCODE_ADD_PLAYER, player_id, _encode_cached(name, encoding),
+            _encode_cached(display_name or name, encoding),
+            _encode_cached(group, encoding), order or player_id)
+        self._flush()
+
     def remove_player(self, player_id: int):
-        if ExtPlayerList2 not in self.extensions:
-            self.write_byte(OPCODE_REMOVE_PLAYER)
-            self.write_short(player_id)
+        if not self.alive:
+            return
+        if self._has_player_list:
+            self._out += _REMOVE_PLAYER.pack(OPCODE_REMOVE_PLAYER, player_id)
+            self._flush()
 
-    @if_alive
     def hold_this(self, block: int, force=False):
-        if ExtPlayerList2 in self.extensions:
-            self.write_byte(OPCODE_HOLD_THIS)
-            self.write_byte(block)
-            self.write_byte(force)
+        if not self.alive:
+            return
+        if self._has_player_list:
+            self._out += _HOLD_THIS.pack(OPCODE_HOLD_THIS, block, force)
+            self._flush()
 
     # Disconnection
 
@@ -167,36 +207,61 @@ class ClientConnectionHandler(ClientSession, BaseConnection):
     # Incoming _handlers
 
     async def _handle_block_change(self):
-        position = await self.read_position()
-        created = await self.read_byte()
-        holding = await self.read_byte()
-        self.handler.change_block(*position, not not created, holding)
+        x, y, z, created, holding = await self.read_struct("3H2B")
+        self.handler.change_block(x, y, z, bool(created), holding)
 
     async def _handle_location_change(self):
-        holding = await self.read_byte()
-        location = await self.read_location()
-        if HeldBlock in self.extensions and holding != self._last_held:
+        loc_struct = self._location_struct
+        data = await self._rx(1 + loc_struct.size)
+        holding = data[0]
+        location = loc_struct.unpack_from(data, 1)
+        if self._has_held_block and holding != self._last_held:
             self.handler.change_held(holding)
             self._last_held = holding
         if location != self._last_location:
             self.handler.change_location(*location)
 
     async def _handle_click(self):
-        button, action = await self.read_struct("2B")
-        yaw, pitch = await self.read_struct("2H")
-        target = await self.read_byte()
-        tx, ty, tz = await self.read_position()
-        target_face = await self.read_byte()
+        button, action, yaw, pitch, target, tx, ty, tz, target_face = \
+            await self.read_struct("2B2HB3HB")
         self.handler.click(button, action, yaw, pitch, target, tx, ty, tz, target_face)
 
+    def _specialize_handlers(self):
+        """Swap in a location handler fused to one read for the negotiated
+        location width."""
+        packet = _s("B" + self._location_struct.format[1:])
+        size = packet.size
+        read = self._rx
+        has_held_block = self._has_held_block
+        last_raw = b''
+
+        async def handle_location_change():
+            nonlocal last_raw
+            raw = await read(size)
+            # a stationary player still sends this every tick; identical
+            # bytes mean identical holding and location, so skip the unpack
+            if raw == last_raw:
+                return
+            last_raw = raw
+            data = packet.unpack(raw)
+            holding = data[0]
+            location = data[1:]
+            if has_held_block and holding != self._last_held:
+                self.handler.change_held(holding)
+                self._last_held = holding
+            if location != self._last_location:
+                self.handler.change_location(*location)
+
+        self._handlers[OPCODE_ABSOLUTE_LOCATION] = handle_location_change
+
     async def _handle_chat_message(self):
         partial_message = await self.read_byte()
-        message_raw = await self.reader.readexactly(64)
+        message_raw = await self._rx(64)
         self._partial_message += message_raw
         if not partial_message:
             message = decode_classic_string(self._partial_message, self._text_encoding)
             self.handler.submit_message(message)
-            self._partial_message = b''
+            self._partial_message.clear()
 
     async def _handle_hello(self):
         if self.username:
@@ -215,6 +280,7 @@ class ClientConnectionHandler(ClientSession, BaseConnection):
 
     def received_extensions(self):
         super().received_extensions()
+        self._specialize_handlers()
         self.handler = self.handler_factory(self)
         assert self.handler is not None, "handler_factory did not return a handler."
 
@@ -241,6 +307,12 @@ class ClientConnectionHandler(ClientSession, BaseConnection):
 
 async def _create_server(handler_factory, ip, port=25565, *args, handler_class=ClientConnectionHandler, **kwargs):
     async def _handle_connection(reader, writer):
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            # Nagle would sit on our many tiny packets (block changes,
+            # position ticks) for up to an RTT; send them immediately
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         session = handler_class(reader, writer, handler_factory)
         await session.handle_forever()
+    kwargs.setdefault("limit", STREAM_BUFFER_LIMIT)
     return await asyncio.start_server(_handle_connection, ip, *args, port=port, **kwargs)
@@ -1,3 +1,9 @@
+from functools import lru_cache
+
+try:  # python-isal is a drop-in zlib with a much faster deflate/inflate
+    from isal import isal_zlib as zlib
+except ImportError:
+    import zlib
 
 __all__ = (
     "chunked",
@@ -8,20 +14,30 @@ __all__ = (
 
 
 def chunked(seq, size):
+    if isinstance(seq, (bytes, bytearray)):
+        seq = memoryview(seq)  # slices become zero-copy views
     return (seq[pos:pos + size] for pos in range(0, len(seq), size))
 
 
 def index_chunked(seq, size):
+    if isinstance(seq, (bytes, bytearray)):
+        seq = memoryview(seq)
     return ((pos, seq[pos:pos + size]) for pos in range(0, len(seq), size))
 
 
 def decode_classic_string(data: bytes, encoding: str = 'ascii') -> str:
     """Convert a string of bytes encoded as a space-padded string into a str."""
-    return str(data.rstrip(), encoding=encoding)
+    return data.rstrip(b'\x00 ').decode(encoding, 'replace')
 
 
 def encode_classic_string(data: str, encoding: str = 'ascii') -> bytes:
     """Convert a str into 64-character space-padded bytes."""
-    if len(data) > 64:
+    encoded = data.encode(encoding)
+    if len(encoded) > 64:
         raise ValueError("The string must fit within 64 characters")
-    return bytes(data, encoding=encoding).ljust(64)
+    return encoded.ljust(64)
+
+
+# write_string runs this for every outgoing name/chat/extension field;
+# repeated strings (broadcasts, MOTDs, extension names) reuse one blob
+_encode_cached = lru_cache(maxsize=4096)(encode_classic_string)